@@ -5,11 +5,21 @@
 
 import os
 import re
-import glob
 import codecs
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    if int(pa.__version__.split('.')[0]) < 14: # Needs concat_tables(promote_options=...)
+        pa = None
+except ImportError: # Fall back to pandas
+    pa = None
 from . import list_ops
+from .utils import mem_check
 
 
 def change_permission(this_path, allow_read=True, allow_write=True):
@@ -36,15 +46,95 @@ def change_permission(this_path, allow_read=True, allow_write=True):
     return
 
 
+def walk(top, threads=32, skip_dirs=('.ipynb_checkpoints',), files_only=False):
+    """Multi-threaded os.walk(), yielding (root, dirs, files) in no particular order.
+
+    Worker threads scan directories with os.scandir() from a shared LIFO stack,
+    so directories on slow/network filesystems are read concurrently.
+    As with os.walk(), symlinks to folders are listed in dirs but not descended into.
+    The dirs & files of each root are sorted. Folders named in skip_dirs are left out.
+    If files_only, files has no broken symlinks/sockets/etc, only (symlinks to) files.
+    """
+    if not os.path.isdir(top):
+        return
+    paths = [top]
+    n_pending = [1] # Directories in the stack or still being scanned
+    errors = []
+    condition = threading.Condition()
+    results = queue.Queue()
+
+    def _scan(path):
+        """Return (dirs, files, subdirs to descend into), or None if the folder can't be read"""
+        dirs, files, subdirs = [], [], []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if entry.name not in skip_dirs:
+                            dirs.append(entry.name)
+                            if not entry.is_symlink():
+                                subdirs.append(entry.path)
+                    elif (not files_only) or entry.is_file():
+                        files.append(entry.name)
+        except OSError:
+            return None # Unreadable folder, os.walk() leaves these out
+        dirs.sort()
+        files.sort()
+        return dirs, files, sorted(subdirs)
+
+    def _worker():
+        while True:
+            with condition:
+                while not paths and n_pending[0] and not errors:
+                    condition.wait()
+                if (not paths) or errors: # Everything has been scanned, or a worker failed
+                    return
+                path = paths.pop()
+            try:
+                scanned = _scan(path)
+            except BaseException as e:
+                with condition:
+                    errors.append(e)
+                    condition.notify_all()
+                results.put(e) # Raised again by the consumer
+                return
+            if scanned is None:
+                with condition:
+                    n_pending[0] -= 1
+                    condition.notify_all()
+                results.put(None) # Only counted by the consumer, not yielded
+                continue
+            dirs, files, subdirs = scanned
+            with condition:
+                paths.extend(subdirs)
+                n_pending[0] += len(subdirs) - 1
+                condition.notify_all()
+            results.put((path, dirs, files, len(subdirs)))
+
+    for _ in range(threads):
+        threading.Thread(target=_worker, daemon=True).start()
+
+    n_remaining = 1
+    while n_remaining:
+        result = results.get()
+        if isinstance(result, BaseException):
+            raise result
+        if result is None: # Unreadable folder
+            n_remaining -= 1
+            continue
+        root, dirs, files, n_subdirs = result
+        n_remaining += n_subdirs - 1
+        yield root, dirs, files
+
+
 def get_list_of_subdir_in_dir(directory):
     """Get list of all subfolders (including the parent folder itself)"""
     list_of_all_dirs = []
-    for root, dirs, files in os.walk(directory):
+    for root, dirs, files in walk(directory):
         if not re.search('/$', root):
             root += os.sep # Add '/' to the end of root
-        if '.ipynb_checkpoints' not in root:
-            list_of_all_dirs.append(root)
-    return list_of_all_dirs
+        list_of_all_dirs.append(root)
+    return sorted(list_of_all_dirs)
 
 def get_list_of_file_paths_in_dir(directory, substrings=None, subfolders=False, regex=False):
     """Yield all file paths under the directory.
@@ -67,42 +157,56 @@ def get_list_of_file_paths_in_dir(directory, substrings=None, subfolders=False,
 
     """
 
-    if subfolders == True:
-        # Look through all subfolders too
-        list_subdir = get_list_of_subdir_in_dir(directory)
-        for this_subdir in list_subdir:
-            yield from get_list_of_file_paths_in_dir(
-                directory=this_subdir, 
-                substrings=substrings, 
-                subfolders=False, # Already considered
-                regex=regex
-            )
-
-    # ⭐️ Get the file paths and names
-    list_of_file_paths = glob.glob(os.path.join(directory,'*'))
-
     if (regex == True) & isinstance(substrings, list):
         raise Exception('If you want to match regex, the substrings should be of str type instead of list')
+
+    # ⭐️ Get the file names in each folder, in a single pass through the subfolders
+    if subfolders == True:
+        # Sorted by folder (the files of each folder are already sorted), so the order doesn't change between runs
+        list_of_roots_and_file_names = sorted((root, files) for root, dirs, files in walk(directory, files_only=True))
+    elif os.path.isdir(directory):
+        with os.scandir(directory) as it:
+            list_of_roots_and_file_names = [(directory, sorted(e.name for e in it if e.is_file()))]
+    else:
+        list_of_roots_and_file_names = []
+    list_of_file_paths_and_names = (
+        (os.path.join(root, file_name), file_name)
+        for root, list_of_file_names in list_of_roots_and_file_names
+        for file_name in list_of_file_names
+        if not file_name.startswith('.') # Hidden files, same as glob('*')
+    )
+
     if (regex == True) & isinstance(substrings, str):
-        for f in list_of_file_paths:
-            if re.search(substrings, os.path.basename(f)):
+        re_substrings = re.compile(substrings)
+        for f, file_name in list_of_file_paths_and_names:
+            if re_substrings.search(file_name):
                 yield f
     if (regex == False) & (substrings != None):
         # Make sure the substring is of list-type
         if isinstance(substrings, str):
             substrings = list(substrings.split(' '))
-        for f in list_of_file_paths:
-            if all(this_substring.upper() in f.upper() for this_substring in substrings):
+        list_of_upper_substrings = [this_substring.upper() for this_substring in substrings]
+        for f, file_name in list_of_file_paths_and_names:
+            upper_f = f.upper()
+            if all(this_substring in upper_f for this_substring in list_of_upper_substrings):
                 yield f
-    if (regex == False) & (substrings == None):
-        for f in list_of_file_paths:
+    if substrings == None:
+        for f, file_name in list_of_file_paths_and_names:
             yield f
 
             
 def get_file_names_from_paths(list_of_file_paths):
     """E.g. 'User/project/file.txt' --> 'file.txt' """
     if list_ops.is_list_like(list_of_file_paths):
-        list_of_file_names = [os.path.basename(this_path) for this_path in list_of_file_paths]
+        if os.altsep is None:
+            # For str paths with only one separator (i.e. not Windows), same as os.path.basename() but ~3x faster.
+            # Other paths (pathlib.Path, bytes) still go through os.path.basename()
+            list_of_file_names = [
+                this_path.rpartition(os.sep)[2] if isinstance(this_path, str) else os.path.basename(this_path)
+                for this_path in list_of_file_paths
+            ]
+        else:
+            list_of_file_names = [os.path.basename(this_path) for this_path in list_of_file_paths]
         return list_of_file_names
     else:
         file_name = os.path.basename(list_of_file_paths)
@@ -112,23 +216,97 @@ def get_file_names_from_paths(list_of_file_paths):
 def get_dir_names_from_paths(list_of_file_paths):
     """E.g. 'User/project/file.txt' --> 'User/project/' """
     if list_ops.is_list_like(list_of_file_paths):
-        list_of_dir_names = list(set([os.path.dirname(this_path)+os.sep for this_path in list_of_file_paths]))
+        list_of_dir_names = list({os.path.dirname(this_path)+os.sep for this_path in list_of_file_paths})
         return list_of_dir_names
     else:
-        dir_name = os.path.dirname(this_path) + os.sep
+        dir_name = os.path.dirname(list_of_file_paths) + os.sep
         return dir_name
 
 
-def read_all_csv_files_in_directory_as_one_df(folder_path, substrings='.csv', subfolders=False):   
+def read_csv_files_as_one_df(list_of_file_paths, filesystem=None, max_workers=8, log_progress=False):
+    """Read CSV files into one DataFrame with the multi-threaded pyarrow parser.
+
+    The files are parsed straight into arrow tables and joined without copying,
+    so no intermediate DataFrame is built per file. Requires pyarrow (>=14).
+
+    Note:
+        Unlike pandas, arrow infers date/timestamp columns (e.g. '2019-01-11'),
+        so those come back as datetime64 instead of object columns.
+        The result also has a fresh RangeIndex, whereas pd.concat() keeps the index of each file.
+
+    Args:
+        list_of_file_paths (list): Local file paths, or paths on the filesystem.
+        filesystem (pyarrow.fs.FileSystem): E.g. pyarrow.fs.S3FileSystem() with 'bucket/key' paths.
+            If None, the paths are local.
+        max_workers (int): Number of files read at the same time.
+        log_progress (bool): If True, log the progress & RAM usage every 50 files.
+
+    Returns:
+        pd.DataFrame
+
+    """
+    if filesystem is not None:
+        _open = filesystem.open_input_stream
+    else:
+        _open = lambda this_file_path: open(this_file_path, 'rb')
+
+    read_options = pacsv.ReadOptions(use_threads=True, encoding='utf8')
+    parse_options = pacsv.ParseOptions(newlines_in_values=True) # Quoted line breaks, like pandas
+    convert_options = pacsv.ConvertOptions(strings_can_be_null=True) # '', 'NA', 'NULL', etc. are NaN, like pandas
+    def _read(this_file_path):
+        with _open(this_file_path) as f:
+            table = pacsv.read_csv(f, read_options=read_options, parse_options=parse_options, convert_options=convert_options)
+        if any(pa.types.is_binary(this_type) for this_type in table.schema.types):
+            # Invalid UTF-8 (read as binary), so drop the bad bytes like codecs.open(..., "ignore")
+            with _open(this_file_path) as f:
+                text = f.read().decode('utf-8', 'ignore')
+            table = pacsv.read_csv(
+                pa.BufferReader(text.encode('utf-8')),
+                read_options=read_options, parse_options=parse_options, convert_options=convert_options
+            )
+        return table
+
+    all_tables = []
+    n_files = len(list_of_file_paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for idx, this_table in enumerate(executor.map(_read, list_of_file_paths)):
+            if log_progress & (idx % 50 == 0):
+                mem_check('Read {}/{}'.format(idx, n_files))
+            all_tables.append(this_table)
+    this_table = None # Drop the loop's reference to the last file's table
+    try:
+        # Missing columns are filled with nulls and numeric types are widened, like pd.concat
+        table = pa.concat_tables(all_tables, promote_options='permissive')
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # Types that arrow can't merge (e.g. int64 & string), so let pandas do it
+        return pd.concat([this_table.to_pandas() for this_table in all_tables], ignore_index=True)
+    del all_tables
+    # The joined table is now the only reference left to the buffers,
+    # so to_pandas() can release each column as soon as it is converted
+    return table.to_pandas(self_destruct=True)
+
+
+def read_all_csv_files_in_directory_as_one_df(folder_path, substrings='.csv', subfolders=False, max_workers=8, engine='pandas'):   
+    """Read all the CSV files in the folder as one DataFrame.
+
+    Args:
+        engine (str): 'pandas', or 'pyarrow' for the faster pyarrow parser
+            (see read_csv_files_as_one_df() for how its results differ).
+            Falls back to 'pandas' if pyarrow (>=14) isn't installed.
+    """
     # Get all file paths in this folder/subfolders
     list_of_file_paths = get_list_of_file_paths_in_dir(folder_path, substrings, subfolders)
     
-    all_df = []
-    for this_file_path in list_of_file_paths:
-        this_file_name = get_file_names_from_paths(this_file_path)
+    if (engine == 'pyarrow') & (pa is not None):
+        return read_csv_files_as_one_df(list(list_of_file_paths), max_workers=max_workers)
+
+    def _read(this_file_path):
         with codecs.open(this_file_path, "r", "utf-8", "ignore") as f:
-            this_df = pd.read_table(f, delimiter=",", low_memory=False)
-        all_df.append(this_df)
+            return pd.read_table(f, delimiter=",", low_memory=False)
+
+    # Several files at once, in the same order
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        all_df = list(executor.map(_read, list_of_file_paths))
 
     df = pd.concat(all_df)
     return df
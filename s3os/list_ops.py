@@ -6,12 +6,17 @@
 import numpy as np
 import pandas as pd
 
+# Most common type first, so isinstance() can stop early
+_list_like = (
+    list, tuple, 
+    np.ndarray, pd.Series
+    )
+
 def is_list_like(variable):
-    list_like = (
-        list, tuple, 
-        np.ndarray, pd.Series
-        )
-    if isinstance(variable, list_like):
-        return True
-    else:
-        return False
+    return isinstance(variable, _list_like)
+
+
+def split_into_chunks(variable, chunk_size):
+    """E.g. [1, 2, 3, 4, 5], 2 --> [1, 2], [3, 4], [5] """
+    for i in range(0, len(variable), chunk_size):
+        yield variable[i:i + chunk_size]
@@ -11,16 +11,59 @@ __author__ = 'Kota Matsuo <kota.matsuo@agoop.co.jp>' # Just for future reference
 
 import os
 import re
+import json
 import codecs
-from io import StringIO
+import asyncio
+import copy
+import itertools
+from io import BytesIO
+from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 import boto3
-# import botocore
+import jmespath
+from boto3.s3.transfer import TransferConfig
+from s3transfer.manager import TransferManager
+from botocore.config import Config
+from botocore.exceptions import ClientError
+try:
+    from pyarrow.fs import S3FileSystem, resolve_s3_region
+except ImportError: # No pyarrow, or pyarrow built without S3 support
+    S3FileSystem = None
+try:
+    import aioboto3
+except ImportError: # Fall back to threads
+    aioboto3 = None
 
 from .utils import mem_check
 from . import file_ops
+from . import list_ops
+
+
+_re_number = re.compile('[0-9]+')
+
+
+def _is_too_large_to_copy(response):
+    """True if CopyObject refused the object for being over 5GB
+
+    (S3 also returns 'InvalidRequest' for other reasons, e.g. copying an object onto itself)
+    """
+    return (
+        isinstance(response, ClientError)
+        and (response.response['Error']['Code'] == 'InvalidRequest')
+        and ('larger than the maximum allowable size' in response.response['Error'].get('Message', ''))
+    )
+
+
+def _event_loop_is_running():
+    """True inside a running asyncio loop (e.g. a Jupyter notebook), where asyncio.run() can't be used"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
 
 
 class S3os:
@@ -28,7 +71,7 @@ class S3os:
         """For performing os module like routines inside S3 repositories.
     
         List of os methods supported:
-            listdir, copy, remove, rename,
+            listdir, copy, remove, remove_many, rename, rename_many,
             download_dir, upload_dir,
             exists, create_if_not_exists, 
             save_dataframe, 
@@ -46,81 +89,240 @@ class S3os:
             # If on AWS Sagemaker
             from sagemaker import get_execution_role
             self.role = get_execution_role()
-        else:
-            pass
-        self.client = boto3.client('s3')
-        self.s3 = boto3.resource('s3')
+        except (ImportError, ValueError): # No sagemaker, or not running on Sagemaker
+            self.role = None
         self.bucket_name = bucket_name
-        self.bucket = self.s3.Bucket(self.bucket_name)
+        # The client & resource are only created when first used, and share
+        # one session so that the credentials are only looked up once
+        self.session = boto3.session.Session()
+        # Connections for up to 64 requests at a time. The listings & batch calls use at most 32 threads,
+        # and _transfer_manager() caps the directory transfers (including multipart parts) to this pool
+        self.config = Config(max_pool_connections=64, retries={'max_attempts': 10, 'mode': 'adaptive'})
+        # Multipart (ranged) transfers for large objects
+        self.transfer_config = TransferConfig(
+            multipart_threshold=8 * 1024**2,
+            multipart_chunksize=8 * 1024**2,
+            max_concurrency=16,
+            use_threads=True
+        )
+
+    def _transfer_manager(self, max_workers):
+        """One TransferManager for a batch of files, sending at most max_workers requests at a time
+
+        The cap covers all the files together, including the parts of multipart transfers,
+        and never exceeds the client's connection pool.
+        """
+        config = copy.copy(self.transfer_config)
+        config.max_concurrency = min(max_workers, self.config.max_pool_connections)
+        return TransferManager(self.client, config)
+
+    @cached_property
+    def client(self):
+        return self.session.client('s3', config=self.config)
+
+    @cached_property
+    def s3(self):
+        return self.session.resource('s3', config=self.config)
+
+    @cached_property
+    def bucket(self):
+        return self.s3.Bucket(self.bucket_name)
+
+    def _parallel_list(self, prefix, expression='Contents[].Key', max_workers=32):
+        """Yield the JMESPath expression results for every object under the prefix
+
+        The subfolders directly under the prefix are listed concurrently,
+        each through its own list_objects_v2 paginator.
+        E.g.
+            expression = 'Contents[].Size'
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
+        compiled = jmespath.compile(expression)
+
+        def _list(this_prefix):
+            pages = paginator.paginate(Bucket=self.bucket_name, Prefix=this_prefix)
+            return [result for result in pages.search(expression) if result is not None]
+
+        # Objects directly under the prefix, and the subfolders to fan out over
+        list_of_subdirs = []
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, Delimiter='/'):
+            yield from compiled.search(page) or []
+            list_of_subdirs += [subdir['Prefix'] for subdir in page.get('CommonPrefixes', [])]
+
+        if list_of_subdirs:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(list_of_subdirs))) as executor:
+                yield from itertools.chain.from_iterable(executor.map(_list, list_of_subdirs))
+
+    def _call_many(self, operation_name, list_of_kwargs, max_workers=32):
+        """Call a client operation once per kwargs concurrently, and return the responses in order
+
+        At most max_workers requests are sent at the same time. Batches larger than that
+        use aioboto3 when it is installed (and no event loop is already running),
+        otherwise a thread pool. Errors are returned in place of their responses.
+        E.g.
+            operation_name = 'delete_objects'
+            list_of_kwargs = [{'Bucket': bucket_name, 'Delete': {...}}, ...]
+        """
+        if (aioboto3 is not None) and (len(list_of_kwargs) > max_workers) and (not _event_loop_is_running()):
+            return asyncio.run(self._call_many_async(operation_name, list_of_kwargs, max_workers))
+
+        method = getattr(self.client, operation_name)
+        def _call(kwargs):
+            try:
+                return method(**kwargs)
+            except Exception as e:
+                return e
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(_call, list_of_kwargs))
+
+    async def _call_many_async(self, operation_name, list_of_kwargs, max_workers):
+        # Same credentials, region & retry settings as self.client
+        credentials = self.session.get_credentials()
+        if credentials is not None:
+            credentials = credentials.get_frozen_credentials()
+            session = aioboto3.Session(
+                aws_access_key_id=credentials.access_key,
+                aws_secret_access_key=credentials.secret_key,
+                aws_session_token=credentials.token,
+                region_name=self.session.region_name
+            )
+        else:
+            session = aioboto3.Session(region_name=self.session.region_name)
+        config = self.config.merge(Config(max_pool_connections=max_workers))
+
+        semaphore = asyncio.Semaphore(max_workers)
+        async with session.client('s3', config=config) as client:
+            method = getattr(client, operation_name)
+            async def _call(kwargs):
+                async with semaphore:
+                    return await method(**kwargs)
+            return await asyncio.gather(*[_call(kwargs) for kwargs in list_of_kwargs], return_exceptions=True)
 
     def listdir(self, dir_path, substring=None):
         """Same as os.listdir() except for S3 objects
         
         Get the list of all file names in 's3://{bucket}/{dir_path}'.
         """
-        list_of_all_files = [this_obj.key for this_obj in self.bucket.objects.filter(Prefix=dir_path)]
         if substring != None:
-            list_of_files = [f for f in list_of_all_files if substring in f]
-            return list_of_files
+            # Filter while the pages come in rather than after listing everything
+            literal = json.dumps(substring).replace('`', '\\`')
+            expression = 'Contents[?contains(Key, `{}`)].Key'.format(literal)
         else:
-            return list_of_all_files
+            expression = 'Contents[].Key'
+        # Sorted to keep the same (lexicographic) order as a single S3 listing
+        return sorted(self._parallel_list(dir_path, expression))
     
     def copy(self, copy_this_key, to_here):
         """Same as os.copy() except for S3 objects
         """
         copy_source = {'Bucket': self.bucket_name,'Key': copy_this_key}
-        self.s3.meta.client.copy(copy_source, self.bucket_name, to_here)
+        self.client.copy(copy_source, self.bucket_name, to_here)
         return
     
     def remove(self, this_key):
         """Same as os.remove() except for S3 objects
+
+        If a list of keys is given, they are deleted in batches with remove_many().
         """
+        if list_ops.is_list_like(this_key):
+            return self.remove_many(this_key)
         obj = self.bucket.Object(this_key)
         response = obj.delete()
         return response
 
+    def remove_many(self, list_of_keys, max_workers=16):
+        """Delete many S3 objects, 1000 keys per request
+
+        The requests are sent concurrently. Returns the errors for any keys that failed to be deleted.
+        """
+        list_of_kwargs = [
+            {
+                'Bucket': self.bucket_name,
+                'Delete': {'Objects': [{'Key': this_key} for this_key in chunk], 'Quiet': True}
+            }
+            for chunk in list_ops.split_into_chunks(list(list_of_keys), 1000)
+        ]
+        errors = []
+        for response in self._call_many('delete_objects', list_of_kwargs, max_workers=max_workers):
+            if isinstance(response, Exception):
+                raise response
+            errors += response.get('Errors', [])
+        return errors
+
     def rename(self, old_key, new_key):
         """Same as os.rename() except for S3 objects
         """
         self.copy(old_key, new_key)
-        self.delete(old_key)
+        self.remove(old_key)
         return
+
+    def rename_many(self, list_of_old_and_new_keys, max_workers=32):
+        """Rename many S3 objects at once
+        
+        The objects are copied concurrently, and the old keys are then
+        deleted with remove_many(). Returns the errors for any keys that failed to be deleted.
+        E.g.
+            list_of_old_and_new_keys = [('data/a.csv', 'data/old/a.csv'), ...]
+        """
+        # Can be an iterator (e.g. zip()), but is walked through more than once
+        list_of_old_and_new_keys = list(list_of_old_and_new_keys)
+        list_of_old_keys = [old_key for old_key, new_key in list_of_old_and_new_keys]
+        list_of_new_keys = [new_key for old_key, new_key in list_of_old_and_new_keys]
+        list_of_kwargs = [
+            {'CopySource': {'Bucket': self.bucket_name, 'Key': old_key}, 'Bucket': self.bucket_name, 'Key': new_key}
+            for old_key, new_key in list_of_old_and_new_keys
+        ]
+        list_of_responses = self._call_many('copy_object', list_of_kwargs, max_workers=max_workers)
+        for old_key, new_key, response in zip(list_of_old_keys, list_of_new_keys, list_of_responses):
+            if _is_too_large_to_copy(response):
+                # Too large (over 5GB) for CopyObject, so use the multipart copy instead
+                self.copy(old_key, new_key)
+            elif isinstance(response, Exception):
+                raise response # Before anything is deleted
+
+        # Only delete once every copy has succeeded
+        return self.remove_many(list_of_old_keys)
     
     def save_dataframe(self, df_to_save, file_path):
         """Same as pd.DataFrame.to_csv()
         E.g.
             file_path = 'data/test.csv'
         """
-        csv_buffer = StringIO() # Use BytesIO for pickle, etc.
-        df_to_save.to_csv(csv_buffer)
-        self.bucket.Object(file_path).put(Body=csv_buffer.getvalue())
+        csv_buffer = BytesIO()
+        df_to_save.to_csv(csv_buffer, encoding='utf-8')
+        csv_buffer.seek(0)
+        # Large frames are sent as a parallel multipart upload
+        self.client.upload_fileobj(csv_buffer, self.bucket_name, file_path, Config=self.transfer_config)
         return
 
-    def download_dir(self, download_this_s3_dir, save_to_this_dir):
-        paginator = self.client.get_paginator('list_objects')
-        paginated_results = paginator.paginate(
-            Bucket=self.bucket_name, 
-            Delimiter=os.sep, 
-            Prefix=download_this_s3_dir
-        )
-        for result in paginated_results:
-            if result.get('CommonPrefixes') is not None:
-                # Download recursively through all the subfolders
-                for subdir in result.get('CommonPrefixes'):
-                    self.download_dir(subdir.get('Prefix'), save_to_this_dir)
-            if result.get('Contents') is not None:
-                for file in result.get('Contents'):
-                    this_file_path = file.get('Key')
-                    this_full_file_path = os.path.join(save_to_this_dir, os.sep, this_file_path)
-                    this_dir = os.path.dirname(this_full_file_path)
-                    if not os.path.exists(this_dir):
-                        os.makedirs(this_dir)
-                    if this_file_path.endswith('/'):
-                        continue
-                    self.client.download_file(self.bucket_name, this_file_path, this_full_file_path)
+    def download_dir(self, download_this_s3_dir, save_to_this_dir, max_workers=64):
+        """Download all files under an S3 directory, keeping the folder structure
+
+        E.g.
+            download_this_s3_dir = 'data/raw/'
+            save_to_this_dir = '/home/ec2-user/SageMaker/project_x/'
+            --> '/home/ec2-user/SageMaker/project_x/data/raw/...'
+        """
+        list_of_keys = list(self._parallel_list(download_this_s3_dir))
+
+        # Create all the local folders up front. makedirs() creates the parents too,
+        # so skip any folder that is followed (in sorted order) by one of its subfolders
+        list_of_dirs = sorted({os.path.dirname(os.path.join(save_to_this_dir, this_key)) for this_key in list_of_keys})
+        for this_dir, next_dir in zip(list_of_dirs, list_of_dirs[1:] + ['']):
+            if not next_dir.startswith(this_dir + os.sep):
+                os.makedirs(this_dir, exist_ok=True)
+
+        with self._transfer_manager(max_workers) as manager:
+            futures = [
+                manager.download(self.bucket_name, this_key, os.path.join(save_to_this_dir, this_key))
+                for this_key in list_of_keys
+                if not this_key.endswith('/') # Skip folder objects
+            ]
+            for future in futures:
+                future.result() # Raise any download error
         return
 
-    def upload_dir(self, local_dir_path, s3_dir_path):
+    def upload_dir(self, local_dir_path, s3_dir_path, max_workers=32):
         """Upload a local directory to S3
         
         E.g.
@@ -133,15 +335,19 @@ class S3os:
         list_of_file_paths = []
         list_of_file_save_path = []
         for this_path in list_of_file_and_dir_paths:
-            this_basename = os.path.basename(this_path)
-            if '.' in this_basename: # Exclude folders
+            if os.path.isfile(this_path): # Exclude folders
                 list_of_file_paths.append(this_path)
                 
                 this_s3_path = this_path.replace(local_dir_path, s3_dir_path)
                 list_of_file_save_path.append(this_s3_path)
         
-        for this_path, this_s3_path in zip(list_of_file_paths, list_of_file_save_path):
-            self.client.upload_file(this_path, self.bucket_name, this_s3_path)
+        with self._transfer_manager(max_workers) as manager:
+            futures = [
+                manager.upload(this_path, self.bucket_name, this_s3_path)
+                for this_path, this_s3_path in zip(list_of_file_paths, list_of_file_save_path)
+            ]
+            for future in futures:
+                future.result() # Raise any upload error
     
 #         for root, dirs, files in os.walk(local_dir_path):
 #             for file in files:
@@ -155,20 +361,8 @@ class S3os:
         Same as os.path.exists()
         """
         
-        response = self.client.list_objects_v2(
-            Bucket = self.bucket_name,
-            Prefix = key_prefix
-        )
-        
-        # Regex to check if a path starts with the key
-        re_prefix = re.compile(key_prefix)
-        
-        # Take the sum of all relevant files
-        size = 0
-        for obj in response.get('Contents', []):
-            this_key = obj['Key']
-            if re_prefix.match(this_key):
-                size += obj['Size']
+        # Take the sum of all files under the key, over every page of the listing
+        size = sum(self._parallel_list(key_prefix, 'Contents[].Size'))
         
         # No files found with the key
         if size == 0:
@@ -176,24 +370,19 @@ class S3os:
         
         if format_size:
             def _format_file_size(size):
-                """Convert bytes to kB, MB, GB"""
+                """Convert bytes to kB, MB, GB, TB"""
                 power = 2**10 #1024
                 n = 0
-                power_labels = {0: '', 1:'k', 2: 'M', 3:'G'}
+                power_labels = {0: '', 1:'k', 2: 'M', 3:'G', 4:'T'}
                 while size > power:
                     size /= power
                     n += 1
                 formated_size = str(round(size, 2)) + ' ' + power_labels[n]+'B'
                 return formated_size
-            # Format total fize size from bytes to kB, MB, GB
+            # Format total fize size from bytes to kB, MB, GB, TB
             size = _format_file_size(size)
     
-        if response.get('KeyCount', []) == 1000:
-            # Check if it reached max key counts
-            min_size = '>'+ str(size)
-            return min_size
-        else:
-            return size
+        return size
 
     def create_if_not_exists(self, key):
         """Creates the folder/file if it doesn't already exist.
@@ -205,35 +394,56 @@ class S3os:
             key (str): For example "folder/folder/file.csv"
 
         """
-        if self.exists(self.bucket_name, key) == None:
+        if self.exists(key) == None:
             self.client.put_object(Bucket=self.bucket_name, Key=key)
             mem_check('Following folder/file created: {}'.format(key))
         else:
             mem_check('Follwoing folder/file already exists: {}'.format(key))
         return
 
-    def read_all_csv_files_in_directory_as_one_df(self, dir_path):
+    def read_all_csv_files_in_directory_as_one_df(self, dir_path, max_workers=32, engine='pandas'):
+        """Read all the numbered CSV files under the S3 directory as one DataFrame
+
+        Args:
+            engine (str): 'pandas', or 'pyarrow' for the faster pyarrow parser
+                (see file_ops.read_csv_files_as_one_df() for how its results differ).
+                Falls back to 'pandas' if pyarrow (>=14, with S3 support) isn't installed.
+        """
+        list_of_all_files = self.listdir(dir_path, substring='.csv')
+        list_of_csv_files = []
+        for file in list_of_all_files:
+            if not file.endswith(".csv"):
+                continue
+            match = _re_number.search(file)
+            if match is None:
+                continue
+            n_patents = int(match.group(0))
+            if n_patents == 0:
+                continue
+            list_of_csv_files.append(file)
+
+        if (engine == 'pyarrow') & (file_ops.pa is not None) & (S3FileSystem is not None):
+            # Read straight from S3 into one arrow table, without a DataFrame per file
+            s3_filesystem = S3FileSystem(region=resolve_s3_region(self.bucket_name))
+            list_of_file_paths = ['{}/{}'.format(self.bucket_name, file) for file in list_of_csv_files]
+            df = file_ops.read_csv_files_as_one_df(
+                list_of_file_paths, filesystem=s3_filesystem, max_workers=max_workers, log_progress=True
+            )
+            mem_check('Read all csv files in directory as one DataFrame')
+            return df
+
+        def _read(file):
+            this_file_path = 's3://{}/{}'.format(self.bucket_name, file)
+            return pd.read_csv(encoding='utf-8', filepath_or_buffer=this_file_path, delimiter=',', low_memory=False)
+
+        # Reading is I/O bound, so read the files concurrently
         all_df = []
-        r_test = re.compile('[0-9]+')
-        list_of_all_files = self.listdir(dir_path)
-        n_files = len(list_of_all_files)
-        for idx, file in enumerate(list_of_all_files):
-            if idx % 50 == 0:
-                mem_check('Read {}/{}'.format(idx, n_files))
-
-            if ( file.endswith(".csv") ) & ( bool(r_test.search(file)) ):
-                start_of_n = r_test.search(file).start()
-                end_of_n   = r_test.search(file).end()
-                n_patents = int(file[start_of_n:end_of_n])
-                if n_patents == 0:
-                    continue
-                this_file_path = 's3://{}/{}'.format(self.bucket_name, file)
-                this_df = pd.read_csv(encoding='utf-8', filepath_or_buffer=this_file_path, delimiter=',', low_memory=False)
-#                 with codecs.open(this_file_path, "r", "utf-8", "ignore") as f:
-#                     this_df = pd.read_table(f, delimiter=",", low_memory=False)
+        n_files = len(list_of_csv_files)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, n_files))) as executor:
+            for idx, this_df in enumerate(executor.map(_read, list_of_csv_files)):
+                if idx % 50 == 0:
+                    mem_check('Read {}/{}'.format(idx, n_files))
                 all_df.append(this_df)
-            else:
-                pass
         df = pd.concat(all_df, axis=0)
         mem_check('Read all csv files in directory as one DataFrame')
         return df
@@ -9,19 +9,30 @@ import logging
 import psutil
 # logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def mem_check(message='no message', logging_level='info'):
-    ''' checks current usage of memory and also outputs message'''
+# Reused between calls, instead of looking up the process every time
+_process = psutil.Process(os.getpid())
+_last_check_time = 0.0
+
+def mem_check(message='no message', logging_level='info', min_interval=0):
+    ''' checks current usage of memory and also outputs message
+
+    Calls within min_interval seconds of the last check are skipped.
+    '''
+    global _process, _last_check_time
     try:
-        rss = psutil.Process(os.getpid()).memory_info().rss  # rss is in bytes
+        level = {'info': logging.INFO, 'debug': logging.DEBUG}.get(logging_level)
+        if (level is None) or (not logging.getLogger().isEnabledFor(level)):
+            return # Nothing would be logged, so don't read the memory usage
+        if min_interval:
+            now = time.monotonic()
+            if now - _last_check_time < min_interval:
+                return
+            _last_check_time = now
+        if _process.pid != os.getpid(): # Forked since the last check
+            _process = psutil.Process(os.getpid())
+        rss = _process.memory_info().rss  # rss is in bytes
         memory = int(rss / 1024**2)  # convert bytes to megabytes
-        if logging_level=='info':
-            logging.info('[{message}] RAM usage: {memory} MB'.format(
-                message=message, memory=memory))
-        elif logging_level=='debug':
-            logging.debug('[{message}] RAM usage: {memory} MB'.format(
-                message=message, memory=memory))
+        logging.log(level, '[%s] RAM usage: %d MB', message, memory)
 
     except Exception as e:
         logging.exception(repr(e) + ' while checking memory usage')
-    finally:
-        time.sleep(0)
\ No newline at end of file